@@ -4,23 +4,70 @@ import os
 import requests
 import datetime
 import pytz
+import numpy as np
 import pandas as pd
 import streamlit as st
 import io
+from copy import copy
+from collections import defaultdict
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
 from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
 from openpyxl.utils import get_column_letter
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 try:
     cache_data = st.cache_data
 except AttributeError:
     cache_data = st.cache
 
+try:
+    cache_resource = st.cache_resource
+except AttributeError:
+    cache_resource = st.experimental_singleton
+
+try:
+    import xlsxwriter
+except ImportError:
+    xlsxwriter = None
+
 # --- Constants ---
 UK_MINIMUM_WAGE = 12.21  # Rate 2 for overtime
 ON_CALL_ROLE_NAME = "On-Call"
 ON_CALL_FLAT_RATE = 15.00  # £15 per shift
 TRAINING_ROLE_NAME = "Training"  # Role name in RotaCloud for training shifts
+LONDON_TZ = pytz.timezone('Europe/London')  # Built once; reused by every timestamp conversion
+API_MAX_WORKERS = 16  # Concurrent Rotacloud requests when fetching period data
+API_USER_BATCH_SIZE = 25  # User ids sent per shifts/leave/attendance request
+CLOSED_PERIOD_CACHE_TTL = 86400  # Seconds; data for a period that has ended no longer changes
+LIVE_PERIOD_CACHE_TTL = 300  # Seconds; the current period's shifts can still be edited
+HTTP_SESSION_CACHE_SIZE = 4  # API keys whose pooled HTTP sessions are kept across reruns
+
+# --- Excel Styles (created once and shared by every cell that uses them) ---
+TITLE_FONT = Font(bold=True, size=14)
+HEADER_FONT = Font(bold=True, color="FFFFFFFF")
+BOLD_FONT = Font(bold=True)
+HEADER_FILL = PatternFill("solid", fgColor="FF4472C4")
+SALARIED_FILL = PatternFill("solid", fgColor="FFE2EFDA")           # Light green
+NON_STANDARD_RATE_FILL = PatternFill("solid", fgColor="FFFCE4D6")  # Light orange
+ON_CALL_FILL = PatternFill("solid", fgColor="FFFFF2CC")            # Light yellow
+TRAINING_FILL = PatternFill("solid", fgColor="FFE8D5F5")           # Light purple for training
+TOTAL_PAY_FILL = PatternFill("solid", fgColor="FFFFFF00")          # Yellow for the payroll total
+NO_FILL = PatternFill(fill_type=None)                              # Rows without a highlight
+TITLE_ALIGNMENT = Alignment(horizontal='center')
+HEADER_ALIGNMENT = Alignment(horizontal='center', vertical='center', wrap_text=True)
+THIN_BORDER = Border(
+    left=Side(style='thin'),
+    right=Side(style='thin'),
+    top=Side(style='thin'),
+    bottom=Side(style='thin')
+)
+CURRENCY_FMT = '"£"#,##0.00'
+NUMBER_FMT = '#,##0.00'
 
 
 # --- Helper Functions for Date Management (11th to 10th Monthly Period) ---
@@ -180,9 +227,23 @@ overtime_rate = st.sidebar.number_input(
     help="Rate applied to hours exceeding contracted hours (default: UK minimum wage)"
 )
 
+# Values-only export (needs xlsxwriter)
+values_only_export = st.sidebar.checkbox(
+    "Values-only Excel export (faster)",
+    value=False,
+    disabled=xlsxwriter is None,
+    help="Write calculated hours and pay as plain values instead of live Excel formulas"
+)
+
 # Generate button
 generate_report_button = st.sidebar.button("Generate Payroll Export", type="primary")
 
+# Refresh button (closed periods are cached for a day, but late shift fixes are common just after the period ends)
+refresh_data_button = st.sidebar.button(
+    "Refresh Rotacloud data",
+    help="Clear cached shifts, leave and attendance so the next export fetches them again"
+)
+
 # --- Main Title ---
 st.title("📊 Payroll Export Spreadsheet Generator")
 
@@ -202,8 +263,6 @@ if not API_KEY:
     st.write("Please provide your Rotacloud API key in the sidebar.")
     st.stop()
 
-HEADERS = {"Authorization": f"Bearer {API_KEY}", "Content-Type": "application/json"}
-
 # --- Base URLs ---
 USERS_BASE_URL = "https://api.rotacloud.com/v1/users"
 SHIFTS_BASE_URL = "https://api.rotacloud.com/v1/shifts"
@@ -211,32 +270,40 @@ LEAVE_BASE_URL = "https://api.rotacloud.com/v1/leave"
 ROLES_BASE_URL = "https://api.rotacloud.com/v1/roles"
 ATTENDANCE_BASE_URL = "https://api.rotacloud.com/v1/attendance"
 
+# --- HTTP Session ---
+# One keep-alive connection pool shared by every Rotacloud request (and the fetch threads),
+# so each call reuses an open TLS connection instead of doing a fresh handshake.
+# The session is cached per API key so its connections also survive Streamlit reruns;
+# only the most recent few keys are kept, so old keys and their pools don't live for the whole process.
+@cache_resource(max_entries=HTTP_SESSION_CACHE_SIZE)
+def get_http_session(api_key):
+    session = requests.Session()
+    session.headers.update({"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"})
+    session.mount("https://", HTTPAdapter(
+        pool_connections=64,
+        pool_maxsize=64,
+        max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+    ))
+    return session
+
+SESSION = get_http_session(API_KEY)
+
 # --- Helper Functions ---
-def date_to_unix_timestamp(date_obj, hour=0, minute=0, second=0, timezone_str='Europe/London'):
+def date_to_unix_timestamp(date_obj, hour=0, minute=0, second=0, tz=LONDON_TZ):
     if not date_obj:
         return None
     try:
-        local_tz = pytz.timezone(timezone_str)
         dt_naive = datetime.datetime.combine(date_obj, datetime.time(hour, minute, second))
-        local_dt = local_tz.localize(dt_naive, is_dst=None)
-        utc_dt = local_dt.astimezone(pytz.utc)
-        return int(utc_dt.timestamp())
+        # timestamp() on an aware datetime is already POSIX seconds; no UTC conversion needed
+        return int(tz.localize(dt_naive, is_dst=None).timestamp())
     except Exception as e:
         st.warning(f"Error converting date '{date_obj}' to timestamp: {e}")
         return None
 
-def date_str_to_date(date_str):
-    if not date_str:
-        return None
-    try:
-        return datetime.datetime.strptime(date_str, "%Y-%m-%d").date()
-    except ValueError:
-        return None
-
 @cache_data(ttl=300)
 def get_rotacloud_users():
     try:
-        resp = requests.get(USERS_BASE_URL, headers=HEADERS, timeout=30)
+        resp = SESSION.get(USERS_BASE_URL, timeout=30)
         resp.raise_for_status()
         return resp.json()
     except requests.exceptions.HTTPError as e:
@@ -246,23 +313,54 @@ def get_rotacloud_users():
         st.error(f"Connection Error: {e}")
         return None
 
-@cache_data(ttl=300)
-def get_rotacloud_shifts(start_ts, end_ts, user_id):
+def request_json(url, params):
+    """
+    GET a Rotacloud list endpoint and return every record.
+    A batch of users can return more records than fit in one response, so pages are
+    followed with offset until the X-Total-Count header's total has been received.
+    """
+    records = []
+    while True:
+        resp = SESSION.get(url, params={**params, "offset": len(records)}, timeout=30)
+        resp.raise_for_status()
+        page = resp.json()
+        records.extend(page)
+        total_count = resp.headers.get("X-Total-Count")
+        if total_count is None or not page or len(records) >= int(total_count):
+            return records
+
+@cache_data(ttl=CLOSED_PERIOD_CACHE_TTL)
+def get_closed_period_records(url, params):
+    return request_json(url, params)
+
+@cache_data(ttl=LIVE_PERIOD_CACHE_TTL)
+def get_live_period_records(url, params):
+    return request_json(url, params)
+
+if refresh_data_button:
+    get_closed_period_records.clear()
+    get_live_period_records.clear()
+    st.sidebar.success("Cached Rotacloud data cleared.")
+
+def get_period_records(url, params, period_closed):
+    """Fetch period data, caching closed periods for a day and the live period for a few minutes."""
+    if period_closed:
+        return get_closed_period_records(url, params)
+    return get_live_period_records(url, params)
+
+def get_rotacloud_shifts(start_ts, end_ts, user_ids, period_closed=False):
     params = {
         "start": start_ts,
         "end": end_ts,
         "published": "true"
     }
-    params["users[]"] = [user_id]
+    params["users[]"] = list(user_ids)
     try:
-        resp = requests.get(SHIFTS_BASE_URL, headers=HEADERS, params=params, timeout=30)
-        resp.raise_for_status()
-        return resp.json()
+        return get_period_records(SHIFTS_BASE_URL, params, period_closed)
     except requests.exceptions.RequestException as e:
         return None
 
-@cache_data(ttl=300)
-def get_rotacloud_leave(start_str, end_str, user_id):
+def get_rotacloud_leave(start_str, end_str, user_ids, period_closed=False):
     params = {
         "start": start_str,
         "end": end_str,
@@ -271,41 +369,97 @@ def get_rotacloud_leave(start_str, end_str, user_id):
         "include_requested": "false",
         "include_expired": "true"
     }
-    params["users[]"] = [user_id]
+    params["users[]"] = list(user_ids)
     try:
-        resp = requests.get(LEAVE_BASE_URL, headers=HEADERS, params=params, timeout=30)
-        resp.raise_for_status()
-        return resp.json()
+        return get_period_records(LEAVE_BASE_URL, params, period_closed)
     except requests.exceptions.RequestException:
         return None
 
-@cache_data(ttl=300)
-def get_attendance_data(start_ts, end_ts, user_id):
-    """Fetch attendance records for a user in the period (for On-Call hour calculations)."""
+def get_attendance_data(start_ts, end_ts, user_ids, period_closed=False):
+    """Fetch attendance records for a batch of users in the period (for On-Call hour calculations)."""
     params = {
         "start": start_ts,
         "end": end_ts
     }
-    params["users[]"] = [user_id]
+    params["users[]"] = list(user_ids)
     try:
-        resp = requests.get(ATTENDANCE_BASE_URL, headers=HEADERS, params=params, timeout=30)
-        resp.raise_for_status()
-        return resp.json()
+        return get_period_records(ATTENDANCE_BASE_URL, params, period_closed)
     except requests.exceptions.RequestException as e:
-        st.warning(f"Warning: Could not fetch attendance data for user {user_id}: {e}")
+        st.warning(f"Warning: Could not fetch attendance data for users {', '.join(map(str, user_ids))}: {e}")
         return None
 
 @cache_data(ttl=600)
-def get_role_name(role_id):
-    if role_id is None:
-        return "Unknown Role"
+def fetch_roles(api_key):
+    """Fetch every role in one request. Raises on failure so an error is never cached; keyed by account."""
+    resp = get_http_session(api_key).get(ROLES_BASE_URL, timeout=30)
+    resp.raise_for_status()
+    return {role["id"]: role.get("name", f"Role {role['id']}") for role in resp.json()}
+
+def get_all_roles():
+    """Returns {role_id: role_name}, or None if the roles could not be fetched."""
     try:
-        resp = requests.get(f"{ROLES_BASE_URL}/{role_id}", headers=HEADERS, timeout=30)
-        resp.raise_for_status()
-        data = resp.json()
-        return data.get("name", f"Role {role_id}")
-    except:
-        return f"Role {role_id}"
+        return fetch_roles(API_KEY)
+    except requests.exceptions.RequestException as e:
+        st.error(f"Error fetching roles: {e}")
+        return None
+
+def group_by_user(batches, batch_responses):
+    """
+    Partition batched API responses (lists of records, or None on failure) into {user_id: [records]}.
+    Returns (records_by_user, failed_user_ids), where failed_user_ids are the users whose batch request failed.
+    """
+    records_by_user = defaultdict(list)
+    failed_user_ids = []
+    for user_ids, records in zip(batches, batch_responses):
+        if records is None:
+            failed_user_ids.extend(user_ids)
+            continue
+        for record in records:
+            records_by_user[record.get("user")].append(record)
+    return records_by_user, failed_user_ids
+
+def batch_user_ids(user_ids):
+    """Split user ids into tuples of at most API_USER_BATCH_SIZE (tuples so they can be cache keys)."""
+    return [
+        tuple(user_ids[i:i + API_USER_BATCH_SIZE])
+        for i in range(0, len(user_ids), API_USER_BATCH_SIZE)
+    ]
+
+def fetch_period_data(user_ids, start_ts, end_ts, start_str, end_str, period_closed, on_call_role_ids):
+    """
+    Fetch shifts, leave and attendance for every user in the period.
+    User ids are sent in batches (one request per batch per endpoint) and the
+    batches are fetched concurrently. Attendance is only requested for users
+    with an On-Call shift in the period, since it is only matched against those.
+    Returns (shifts_by_user, leave_by_user, attendance_by_user, failed_user_ids), the first three
+    each {user_id: [records]} and failed_user_ids the users whose shifts or leave could not be fetched.
+    """
+    batches = batch_user_ids(user_ids)
+    with ThreadPoolExecutor(
+        max_workers=API_MAX_WORKERS,
+        initializer=add_script_run_ctx,
+        initargs=(None, get_script_run_ctx())
+    ) as executor:
+        shift_batches = executor.map(
+            lambda ids: get_rotacloud_shifts(start_ts, end_ts, ids, period_closed), batches
+        )
+        leave_batches = executor.map(
+            lambda ids: get_rotacloud_leave(start_str, end_str, ids, period_closed), batches
+        )
+        shifts_by_user, failed_shift_ids = group_by_user(batches, shift_batches)
+        leave_by_user, failed_leave_ids = group_by_user(batches, leave_batches)
+
+        on_call_user_ids = [
+            user_id for user_id in user_ids
+            if any(shift.get("role") in on_call_role_ids for shift in shifts_by_user.get(user_id, []))
+        ]
+        attendance_batches = batch_user_ids(on_call_user_ids)
+        # A failed attendance batch is already reported by get_attendance_data
+        attendance_by_user, _ = group_by_user(attendance_batches, executor.map(
+            lambda ids: get_attendance_data(start_ts, end_ts, ids, period_closed), attendance_batches
+        ))
+        failed_user_ids = sorted(set(failed_shift_ids) | set(failed_leave_ids))
+        return shifts_by_user, leave_by_user, attendance_by_user, failed_user_ids
 
 def get_user_pay_details(user_data):
     pay_info = {
@@ -329,105 +483,118 @@ def get_user_pay_details(user_data):
     
     return pay_info
 
-def calculate_shift_hours_by_role(shifts_json, user_pay_details, default_hourly_rate, all_custom_roles, role_id_to_name):
+def flush_debug_lines(title, debug_lines):
+    """Render buffered debug lines with a single Streamlit element instead of one write per line."""
+    if debug_lines:
+        st.expander(title).code("\n".join(debug_lines))
+
+def flush_debug_markdown(debug_lines):
+    """Render buffered debug markdown as one Streamlit element and empty the buffer."""
+    if debug_lines:
+        st.markdown("\n\n".join(debug_lines))
+        debug_lines.clear()
+
+def calculate_shift_hours_by_user(all_shifts, pay_details_by_user, role_id_to_name):
     """
-    Calculate hours worked, broken down by role rate.
+    Calculate hours worked for every user at once, broken down by role rate.
     EXCLUDES On-Call and Training shifts from the main hour calculations (they are handled separately).
-    Returns: total_hours, hours_at_base_rate, dict of {role_id: (hours, rate, role_name)},
-             on_call_shifts_list, training_hours (float)
+    All shifts in the period go into one DataFrame and the per-user totals come from groupby sums.
+    Returns: {user_id: (total_hours, hours_at_base_rate, dict of {role_id: {'hours', 'rate', 'name'}},
+             on_call_shifts_list, training_hours)}
     """
-    total_seconds = 0
-    base_rate_seconds = 0
-    role_hours = {}  # {role_id: {'seconds': 0, 'rate': rate, 'name': name}}
-    on_call_shifts = []  # List of On-Call shift records for attendance lookup
-    training_seconds = 0  # Training hours calculated from scheduled shift times
-
-    if not shifts_json:
-        return 0.0, 0.0, {}, on_call_shifts, 0.0
+    if not all_shifts:
+        return {}
+
+    debug_lines = []
+
+    # Resolve the special roles to id sets up front so shifts are classified by id alone
+    on_call_role_ids = {rid for rid, name in role_id_to_name.items() if name == ON_CALL_ROLE_NAME}
+    training_role_ids = {rid for rid, name in role_id_to_name.items() if name == TRAINING_ROLE_NAME}
+
+    # One row per shift; "pos" keeps the position of the original record in all_shifts
+    shifts_df = pd.DataFrame(all_shifts, columns=["id", "user", "start_time", "end_time", "minutes_break", "role"])
+    shifts_df["pos"] = shifts_df.index
+    shifts_df["role"] = shifts_df["role"].astype("Int64")
+    shifts_df = shifts_df.dropna(subset=["start_time", "end_time"])
+    shifts_df["net_seconds"] = (
+        shifts_df["end_time"] - shifts_df["start_time"] - shifts_df["minutes_break"].fillna(0) * 60
+    )
+    shifts_df["is_on_call"] = shifts_df["role"].isin(on_call_role_ids)
+    shifts_df["is_training"] = shifts_df["role"].isin(training_role_ids)
+
+    # Attach each user's custom rate for the shift's role (NaN when the role has no custom rate)
+    rates_df = pd.DataFrame(
+        [(user_id, role_id, rate)
+         for user_id, pay_details in pay_details_by_user.items()
+         for role_id, rate in pay_details["role_rates"].items()],
+        columns=["user", "role", "rate"]
+    ).astype({"user": shifts_df["user"].dtype, "role": "Int64", "rate": "float64"})
+    shifts_df = shifts_df.merge(rates_df, on=["user", "role"], how="left")
+
+    regular_df = shifts_df[~(shifts_df["is_on_call"] | shifts_df["is_training"])]
+    has_custom_rate = regular_df["rate"].notna()
+
+    # Per-user sums in seconds, converted to hours with one division each
+    total_hours = regular_df.groupby("user")["net_seconds"].sum() / 3600
+    base_rate_hours = regular_df[~has_custom_rate].groupby("user")["net_seconds"].sum() / 3600
+    training_hours = shifts_df[shifts_df["is_training"]].groupby("user")["net_seconds"].sum() / 3600
+    role_hours = regular_df[has_custom_rate].groupby(["user", "role"], sort=False)["net_seconds"].sum() / 3600
+
+    role_hours_by_user = defaultdict(dict)
+    for (user_id, role_id), hours in role_hours.items():
+        role_id = int(role_id)
+        role_hours_by_user[user_id][role_id] = {
+            'hours': round(float(hours), 2),
+            'rate': pay_details_by_user[user_id]["role_rates"][role_id],
+            'name': role_id_to_name.get(role_id, f"Role {role_id}")
+        }
 
-    role_rates = user_pay_details.get("role_rates", {})
+    # On-Call: exclude from normal hours, collect for attendance lookup
+    on_call_by_user = defaultdict(list)
+    for pos in shifts_df.loc[shifts_df["is_on_call"], "pos"]:
+        shift_get = all_shifts[pos].get
+        on_call_by_user[shift_get("user")].append({
+            "shift_id": shift_get("id"),
+            "start_time": shift_get("start_time"),
+            "end_time": shift_get("end_time"),
+            "minutes_break": shift_get("minutes_break", 0) or 0
+        })
 
     if DEBUG_MODE:
-        st.write(f"🔍 **DEBUG: Processing {len(shifts_json)} shifts**")
-
-    for shift in shifts_json:
-        st_unix = shift.get("start_time")
-        en_unix = shift.get("end_time")
-        minutes_break = shift.get("minutes_break", 0) or 0
-        role_id = shift.get("role")
-        shift_id = shift.get("id")
-
-        # Get role name for this shift
-        if role_id not in role_id_to_name:
-            role_id_to_name[role_id] = get_role_name(role_id)
-        role_name = role_id_to_name.get(role_id, "Unknown")
-
-        if st_unix is None or en_unix is None:
-            continue
-
-        # --- On-Call: exclude from normal hours, collect for attendance lookup ---
-        if role_name == ON_CALL_ROLE_NAME:
-            if DEBUG_MODE:
-                st.write(f"   ✅ Found On-Call shift: ID={shift_id}, Role={role_name}")
-            on_call_shifts.append({
-                "shift_id": shift_id,
-                "start_time": st_unix,
-                "end_time": en_unix,
-                "minutes_break": minutes_break
-            })
-            continue
-
-        # --- Training: exclude from normal hours, accumulate from scheduled times ---
-        if role_name == TRAINING_ROLE_NAME:
-            duration = en_unix - st_unix
-            net_seconds = duration - minutes_break * 60
-            training_seconds += net_seconds
-            if DEBUG_MODE:
-                st.write(f"   📚 Found Training shift: ID={shift_id}, hours={net_seconds/3600:.2f}")
-            continue
+        for user_id, user_df in shifts_df.groupby("user", sort=False):
+            debug_lines.append(f"🔍 DEBUG: User {user_id}: processing {len(user_df)} shifts")
+            for pos, is_on_call, is_training, net_seconds in zip(
+                user_df["pos"], user_df["is_on_call"], user_df["is_training"], user_df["net_seconds"]
+            ):
+                shift = all_shifts[pos]
+                shift_id = shift.get("id")
+                role_name = role_id_to_name.get(shift.get("role"), f"Role {shift.get('role')}")
+                if is_on_call:
+                    debug_lines.append(f"   ✅ Found On-Call shift: ID={shift_id}, Role={role_name}")
+                elif is_training:
+                    debug_lines.append(f"   📚 Found Training shift: ID={shift_id}, hours={net_seconds/3600:.2f}")
+                else:
+                    debug_lines.append(f"   ℹ️ Regular shift: ID={shift_id}, Role={role_name}")
+
+    summary = {}
+    for user_id in shifts_df["user"].unique().tolist():
+        summary[user_id] = (
+            round(float(total_hours.get(user_id, 0.0)), 2),
+            round(float(base_rate_hours.get(user_id, 0.0)), 2),
+            role_hours_by_user.get(user_id, {}),
+            on_call_by_user.get(user_id, []),
+            round(float(training_hours.get(user_id, 0.0)), 2)
+        )
 
-        # --- Regular shift ---
-        if DEBUG_MODE and role_name:
-            st.write(f"   ℹ️ Regular shift: ID={shift_id}, Role={role_name}")
+    flush_debug_lines("🔍 Debug: shift breakdown", debug_lines)
+    return summary
 
-        duration = en_unix - st_unix
-        net_seconds = duration - minutes_break * 60
-        total_seconds += net_seconds
-        
-        # Check if this role has a custom rate
-        if role_id and role_id in role_rates:
-            custom_rate = role_rates[role_id]
-            if role_id not in role_hours:
-                role_name_fetched = get_role_name(role_id)
-                role_hours[role_id] = {'seconds': 0, 'rate': custom_rate, 'name': role_name_fetched}
-                all_custom_roles[role_id] = role_name_fetched
-            role_hours[role_id]['seconds'] += net_seconds
-        else:
-            base_rate_seconds += net_seconds
-    
-    # Convert to hours
-    total_hours = round(total_seconds / 3600, 2)
-    base_rate_hours = round(base_rate_seconds / 3600, 2)
-    training_hours = round(training_seconds / 3600, 2)
-    
-    role_hours_converted = {}
-    for role_id, data in role_hours.items():
-        role_hours_converted[role_id] = {
-            'hours': round(data['seconds'] / 3600, 2),
-            'rate': data['rate'],
-            'name': data['name']
-        }
-    
-    return total_hours, base_rate_hours, role_hours_converted, on_call_shifts, training_hours
-
-def unix_to_datetime(unix_ts, timezone_str='Europe/London'):
+def unix_to_datetime(unix_ts, tz=LONDON_TZ):
     """Convert Unix timestamp to timezone-aware datetime."""
     if not unix_ts:
         return None
     try:
-        utc_dt = datetime.datetime.fromtimestamp(unix_ts, tz=pytz.utc)
-        local_tz = pytz.timezone(timezone_str)
-        return utc_dt.astimezone(local_tz)
+        return datetime.datetime.fromtimestamp(unix_ts, tz=tz)
     except Exception:
         return None
 
@@ -436,61 +603,57 @@ def calculate_on_call_hours(on_call_shifts, attendance_data):
     Calculate On-Call hours from attendance data using in_time and out_time.
     Returns: total_on_call_hours, number_of_on_call_shifts (all assigned, not just attended)
     """
+    debug_lines = []
     if DEBUG_MODE:
-        st.write(f"🔍 **DEBUG: calculate_on_call_hours called**")
-        st.write(f"   - On-Call shifts provided: {len(on_call_shifts) if on_call_shifts else 0}")
-        st.write(f"   - Attendance records provided: {len(attendance_data) if attendance_data else 0}")
+        debug_lines.append(f"🔍 DEBUG: calculate_on_call_hours called")
+        debug_lines.append(f"   - On-Call shifts provided: {len(on_call_shifts) if on_call_shifts else 0}")
+        debug_lines.append(f"   - Attendance records provided: {len(attendance_data) if attendance_data else 0}")
 
     if not on_call_shifts:
         if DEBUG_MODE:
-            st.write("   ⚠️ No On-Call shifts to process")
+            debug_lines.append("   ⚠️ No On-Call shifts to process")
+        flush_debug_lines("🔍 Debug: On-Call hours", debug_lines)
         return 0.0, 0
 
     total_on_call_shifts = len(on_call_shifts)
 
     if not attendance_data:
         if DEBUG_MODE:
-            st.write("   ⚠️ No attendance data to process")
+            debug_lines.append("   ⚠️ No attendance data to process")
+        flush_debug_lines("🔍 Debug: On-Call hours", debug_lines)
         return 0.0, total_on_call_shifts
 
     total_on_call_hours = 0.0
 
-    shift_lookup = {}
-    for shift in on_call_shifts:
-        shift_id = shift.get("shift_id")
-        if not shift_id:
-            continue
-        shift_lookup[shift_id] = {
-            "start_time": shift.get("start_time"),
-            "end_time": shift.get("end_time"),
-            "minutes_break": shift.get("minutes_break", 0) or 0
-        }
+    # The On-Call records already carry normalised times, so index them directly by shift id
+    shift_lookup = {shift["shift_id"]: shift for shift in on_call_shifts if shift.get("shift_id")}
 
     if DEBUG_MODE:
-        st.write(f"   📋 Built lookup for {len(shift_lookup)} On-Call shifts: {list(shift_lookup.keys())}")
+        debug_lines.append(f"   📋 Built lookup for {len(shift_lookup)} On-Call shifts: {list(shift_lookup.keys())}")
 
     for attendance in attendance_data:
-        if attendance.get("deleted"):
+        attendance_get = attendance.get
+        if attendance_get("deleted"):
             continue
 
-        shift_id = attendance.get("shift")
-        in_time = attendance.get("in_time")
-        out_time = attendance.get("out_time")
+        shift_id = attendance_get("shift")
+        in_time = attendance_get("in_time")
+        out_time = attendance_get("out_time")
 
         if DEBUG_MODE:
-            st.write(f"   🔎 Checking attendance: shift_id={shift_id}, in_time={in_time}, out_time={out_time}")
+            debug_lines.append(f"   🔎 Checking attendance: shift_id={shift_id}, in_time={in_time}, out_time={out_time}")
 
         if shift_id not in shift_lookup:
             if DEBUG_MODE:
-                st.write(f"      ⏭️ Shift {shift_id} not in On-Call lookup")
+                debug_lines.append(f"      ⏭️ Shift {shift_id} not in On-Call lookup")
             continue
 
         if DEBUG_MODE:
-            st.write(f"      ✅ MATCHED On-Call shift {shift_id}!")
+            debug_lines.append(f"      ✅ MATCHED On-Call shift {shift_id}!")
 
         if not in_time or not out_time:
             if DEBUG_MODE:
-                st.write(f"      ⚠️ Missing in_time or out_time")
+                debug_lines.append(f"      ⚠️ Missing in_time or out_time")
             continue
 
         try:
@@ -504,9 +667,9 @@ def calculate_on_call_hours(on_call_shifts, attendance_data):
             hours_worked = (out_time - in_time) / 3600.0
 
             if DEBUG_MODE:
-                st.write(f"      📊 Hours calculated: {hours_worked:.2f}")
-                st.write(f"         Clock in:  {in_time_dt.strftime('%Y-%m-%d %H:%M:%S')}")
-                st.write(f"         Clock out: {out_time_dt.strftime('%Y-%m-%d %H:%M:%S')}")
+                debug_lines.append(f"      📊 Hours calculated: {hours_worked:.2f}")
+                debug_lines.append(f"         Clock in:  {in_time_dt.strftime('%Y-%m-%d %H:%M:%S')}")
+                debug_lines.append(f"         Clock out: {out_time_dt.strftime('%Y-%m-%d %H:%M:%S')}")
 
             if hours_worked <= 0:
                 st.warning(f"Invalid On-Call hours for shift {shift_id}: {hours_worked:.2f} hours")
@@ -518,47 +681,53 @@ def calculate_on_call_hours(on_call_shifts, attendance_data):
             total_on_call_hours += hours_worked
 
             if DEBUG_MODE:
-                st.write(f"      ✅ Added to totals. Running total: {total_on_call_hours:.2f} hours")
+                debug_lines.append(f"      ✅ Added to totals. Running total: {total_on_call_hours:.2f} hours")
 
         except (TypeError, ValueError) as e:
             st.warning(f"Could not calculate On-Call hours for shift {shift_id}: {e}")
 
     if DEBUG_MODE:
-        st.write(f"   🎯 **FINAL RESULT: {total_on_call_hours:.2f} hours from {total_on_call_shifts} assigned shifts**")
+        debug_lines.append(f"   🎯 FINAL RESULT: {total_on_call_hours:.2f} hours from {total_on_call_shifts} assigned shifts")
 
+    flush_debug_lines("🔍 Debug: On-Call hours", debug_lines)
     return round(total_on_call_hours, 2), total_on_call_shifts
 
-def calculate_leave_hours(leave_json, report_start_date, report_end_date):
-    """Calculate total approved holiday and sickness within the period."""
-    holiday_days = 0.0
-    holiday_hours = 0.0
-    sickness_days = 0.0
-    
-    if not leave_json:
-        return 0.0, 0.0, 0.0
-    
-    for record in leave_json:
-        if record.get("status") != "approved":
-            continue
-        
-        leave_type = record.get("type")
-        
-        for date_entry in record.get("dates", []):
-            dstr = date_entry.get("date")
-            ddate = date_str_to_date(dstr)
-            if not ddate:
-                continue
-            if report_start_date <= ddate <= report_end_date:
-                days_val = date_entry.get("days", 0) or 0
-                hours_val = date_entry.get("hours", 0) or 0
-                
-                if leave_type == 1:  # Holiday
-                    holiday_days += days_val
-                    holiday_hours += hours_val
-                elif leave_type == 3:  # Sickness
-                    sickness_days += days_val
-    
-    return round(holiday_days, 2), round(holiday_hours, 2), round(sickness_days, 2)
+def calculate_leave_hours_by_user(leave_by_user, report_start_date, report_end_date):
+    """
+    Calculate total approved holiday and sickness within the period for every user at once.
+    Every approved leave date goes into one DataFrame and the per-user totals come from groupby sums.
+    Returns: {user_id: (holiday_days, holiday_hours, sickness_days)}
+    """
+    leave_df = pd.DataFrame(
+        [(user_id, record.get("type"), date_entry.get("date"),
+          date_entry.get("days", 0) or 0, date_entry.get("hours", 0) or 0)
+         for user_id, records in leave_by_user.items()
+         for record in records if record.get("status") == "approved"
+         for date_entry in record.get("dates", [])],
+        columns=["user", "type", "date", "days", "hours"]
+    )
+    if leave_df.empty:
+        return {}
+
+    # Unparseable dates become NaT and fall out of the period filter
+    leave_df["date"] = pd.to_datetime(leave_df["date"], format="%Y-%m-%d", errors="coerce", cache=True)
+    leave_df = leave_df[
+        (leave_df["date"] >= pd.Timestamp(report_start_date)) & (leave_df["date"] <= pd.Timestamp(report_end_date))
+    ]
+
+    holiday_df = leave_df[leave_df["type"] == 1]  # Holiday
+    holiday_days = holiday_df.groupby("user")["days"].sum()
+    holiday_hours = holiday_df.groupby("user")["hours"].sum()
+    sickness_days = leave_df[leave_df["type"] == 3].groupby("user")["days"].sum()  # Sickness
+
+    return {
+        user_id: (
+            round(float(holiday_days.get(user_id, 0.0)), 2),
+            round(float(holiday_hours.get(user_id, 0.0)), 2),
+            round(float(sickness_days.get(user_id, 0.0)), 2),
+        )
+        for user_id in leave_df["user"].unique().tolist()
+    }
 
 def calculate_fixed_hours(weekly_hours, period_days):
     """
@@ -577,29 +746,8 @@ def calculate_fixed_hours(weekly_hours, period_days):
     return round(fixed_hours, 2)
 
 
-def create_payroll_excel(payroll_data, start_date, end_date, overtime_rate, all_custom_roles):
-    """Create Excel workbook with payroll data."""
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Payroll Export"
-    
-    # Styles
-    header_font = Font(bold=True, color="FFFFFF")
-    header_fill = PatternFill("solid", fgColor="4472C4")
-    salaried_fill = PatternFill("solid", fgColor="E2EFDA")        # Light green
-    non_standard_rate_fill = PatternFill("solid", fgColor="FCE4D6")  # Light orange
-    on_call_fill = PatternFill("solid", fgColor="FFF2CC")          # Light yellow
-    training_fill = PatternFill("solid", fgColor="E8D5F5")         # Light purple for training
-    currency_format = '£#,##0.00'
-    number_format = '#,##0.00'
-    thin_border = Border(
-        left=Side(style='thin'),
-        right=Side(style='thin'),
-        top=Side(style='thin'),
-        bottom=Side(style='thin')
-    )
-    
-    # Build dynamic headers
+def get_export_headers(sorted_custom_roles):
+    """Column headers for the payroll export, with a Hrs/Rate pair per custom role."""
     base_headers = [
         "Employee Name",
         "Pay Type",
@@ -612,8 +760,7 @@ def create_payroll_excel(payroll_data, start_date, end_date, overtime_rate, all_
     
     # Custom role columns
     custom_role_headers = []
-    sorted_roles = sorted(all_custom_roles.items(), key=lambda x: x[1])
-    for role_id, role_name in sorted_roles:
+    for role_id, role_name in sorted_custom_roles:
         custom_role_headers.append(f"{role_name} Hrs")
         custom_role_headers.append(f"{role_name} Rate (£)")
     
@@ -639,236 +786,377 @@ def create_payroll_excel(payroll_data, start_date, end_date, overtime_rate, all_
         "TOTAL PAY (£)"
     ]
     
-    headers = base_headers + custom_role_headers + on_call_headers + training_headers + end_headers
-    
-    # Row 1: Period header
-    ws.merge_cells(start_row=1, start_column=1, end_row=1, end_column=len(headers))
-    period_cell = ws.cell(row=1, column=1)
-    period_cell.value = f"Payroll Period: {start_date.strftime('%d/%m/%Y')} - {end_date.strftime('%d/%m/%Y')}"
-    period_cell.font = Font(bold=True, size=14)
-    period_cell.alignment = Alignment(horizontal='center')
+    return base_headers + custom_role_headers + on_call_headers + training_headers + end_headers
+
+def get_row_fill(data):
+    """Row highlight for an employee in the export (NO_FILL for no highlight)."""
+    STANDARD_RATE = 12.21
+    is_salaried = data['pay_type'] == 'annual'
+    is_non_standard_rate = not is_salaried and abs(data['rate_1'] - STANDARD_RATE) > 0.01
+
+    # Row highlight priority: on-call > training > salaried > non-standard rate
+    if data['on_call_hours'] > 0:
+        return ON_CALL_FILL
+    if data['training_hours'] > 0:
+        return TRAINING_FILL
+    if is_salaried:
+        return SALARIED_FILL
+    if is_non_standard_rate:
+        return NON_STANDARD_RATE_FILL
+    return NO_FILL
+
+def get_export_layout(sorted_custom_roles):
+    """
+    Column layout shared by both payroll exporters, as 1-based column indexes matching get_export_headers.
+    Returns a dict with the index of each fixed column ('weekly_hrs', 'hours', 'total_pay', ...) plus:
+      'custom_role_cols': [(hrs_col, rate_col)] for each custom role, in sorted_custom_roles order
+      'column_formats':   number format per column (index 0 unused)
+      'bold_columns':     columns shown in bold
+      'sum_columns':      columns totalled in the TOTALS row
+    """
+    layout = {
+        'weekly_hrs': 3,   # C
+        'total_hrs': 4,    # D
+        'fixed_hrs': 5,    # E
+        'hours': 6,        # F
+        'rate1': 7,        # G
+    }
+    custom_role_start_col = 8
+    layout['custom_role_cols'] = [
+        (custom_role_start_col + 2 * i, custom_role_start_col + 2 * i + 1)
+        for i in range(len(sorted_custom_roles))
+    ]
+
+    next_col = custom_role_start_col + 2 * len(sorted_custom_roles)
+    for name in ('on_call_hrs', 'on_call_shifts', 'on_call_flat_rate',
+                 'training_hrs', 'training_pay',  # Training Pay is calculated: Training Hrs × Rate 2
+                 'overtime_hrs', 'rate2', 'holiday_days', 'holiday_hrs', 'sickness_days', 'total_pay'):
+        layout[name] = next_col
+        next_col += 1
+
+    column_formats = [None] * next_col
+    for name in ('weekly_hrs', 'total_hrs', 'fixed_hrs', 'hours', 'on_call_hrs', 'on_call_shifts',
+                 'training_hrs', 'overtime_hrs', 'holiday_days', 'holiday_hrs', 'sickness_days'):
+        column_formats[layout[name]] = NUMBER_FMT
+    for name in ('rate1', 'on_call_flat_rate', 'training_pay', 'rate2', 'total_pay'):
+        column_formats[layout[name]] = CURRENCY_FMT
+    for hrs_col, rate_col in layout['custom_role_cols']:
+        column_formats[hrs_col] = NUMBER_FMT
+        column_formats[rate_col] = CURRENCY_FMT
+    layout['column_formats'] = column_formats
+
+    layout['bold_columns'] = frozenset(layout[name] for name in (
+        'fixed_hrs', 'hours', 'on_call_hrs', 'training_hrs', 'training_pay', 'overtime_hrs', 'total_pay'
+    ))
+    layout['sum_columns'] = [
+        layout['weekly_hrs'], layout['total_hrs'], layout['fixed_hrs'], layout['hours'],
+        *(hrs_col for hrs_col, rate_col in layout['custom_role_cols']),
+        layout['on_call_hrs'], layout['on_call_shifts'],
+        layout['training_hrs'],
+        layout['overtime_hrs'],
+        layout['holiday_days'], layout['holiday_hrs'], layout['sickness_days'],
+        layout['total_pay'],
+    ]
+    return layout
+
+def get_export_row_values(data, sorted_custom_roles, overtime_rate, hours, training_pay, overtime_hrs, total_pay):
+    """
+    Cell values for one employee row, in export column order.
+    The calculated columns (Hours, Training Pay, Overtime, TOTAL PAY) are passed in,
+    as formulas or as worked-out values depending on the exporter.
+    """
+    custom_role_values = []
+    for role_id, role_name in sorted_custom_roles:
+        role_data = data['custom_role_hours'].get(role_id, {'hours': 0, 'rate': 0})
+        custom_role_values.extend([role_data['hours'], role_data['rate']])
+
+    return [
+        data['employee_name'],
+        "Salaried" if data['pay_type'] == 'annual' else "Hourly",
+        data['weekly_hours'],
+        data['total_hours_display'],
+        data['fixed_hours'],
+        hours,
+        data['rate_1'],
+        *custom_role_values,
+        data['on_call_hours'],
+        data['on_call_shift_count'],
+        ON_CALL_FLAT_RATE,
+        data['training_hours'],
+        training_pay,
+        overtime_hrs,
+        overtime_rate,
+        data['holiday_days'],
+        data['holiday_hours'],
+        data['sickness_days'],
+        total_pay,
+    ]
+
+def create_payroll_excel(payroll_data, preview_df, start_date, end_date, overtime_rate, sorted_custom_roles):
+    """Create the payroll Excel export and return it as an in-memory .xlsx file (BytesIO).
+
+    Uses a write-only workbook: each row is styled and streamed out as soon as it
+    is built, so no row is held in memory once it has been appended.
+    Data rows keep live formulas; the TOTALS row holds plain values, using the
+    preview's worked-out Hours, Overtime and Total Pay for the formula columns.
+    """
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Payroll Export")
+
+    def mk_cell(value=None, font=None, fill=None, number_format=None, alignment=None, border=THIN_BORDER):
+        """WriteOnlyCell for this sheet with only the given styles set."""
+        cell = WriteOnlyCell(ws, value=value)
+        if border:
+            cell.border = border
+        if font:
+            cell.font = font
+        if fill:
+            cell.fill = fill
+        if number_format:
+            cell.number_format = number_format
+        if alignment:
+            cell.alignment = alignment
+        return cell
     
-    # Row 2: Column headers
-    for col, header in enumerate(headers, 1):
-        cell = ws.cell(row=2, column=col, value=header)
-        cell.font = header_font
-        cell.fill = header_fill
-        cell.alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
-        cell.border = thin_border
+    headers = get_export_headers(sorted_custom_roles)
+    layout = get_export_layout(sorted_custom_roles)
+    column_formats = layout['column_formats']
+    bold_columns = layout['bold_columns']
     
-    # Column widths
+    # Letter for every column index, looked up by index for the rest of the export (index 0 unused)
+    col_letters = [None] + [get_column_letter(col_idx) for col_idx in range(1, len(headers) + 1)]
+
+    # Column widths and row layout (must be set before the first row is written)
     ws.column_dimensions['A'].width = 25
     ws.column_dimensions['B'].width = 10
     for col_idx in range(3, len(headers) + 1):
-        ws.column_dimensions[get_column_letter(col_idx)].width = 14
+        ws.column_dimensions[col_letters[col_idx]].width = 14
+    ws.row_dimensions[2].height = 30
+    ws.merged_cells.add(f"A1:{col_letters[-1]}1")
     
-    # --- Column index assignments ---
-    weekly_hrs_col = 3   # C
-    total_hrs_col = 4    # D
-    fixed_hrs_col = 5    # E
-    hours_col = 6        # F
-    rate1_col = 7        # G
-
-    custom_role_start_col = 8
-    num_custom_role_cols = len(custom_role_headers)
+    # Row 1: Period header
+    ws.append([mk_cell(
+        f"Payroll Period: {start_date.strftime('%d/%m/%Y')} - {end_date.strftime('%d/%m/%Y')}",
+        font=TITLE_FONT, alignment=TITLE_ALIGNMENT, border=None
+    )])
+    
+    # Row 2: Column headers
+    ws.append([
+        mk_cell(header, font=HEADER_FONT, fill=HEADER_FILL, alignment=HEADER_ALIGNMENT)
+        for header in headers
+    ])
 
-    on_call_hrs_col       = custom_role_start_col + num_custom_role_cols
-    on_call_shifts_col    = on_call_hrs_col + 1
-    on_call_flat_rate_col = on_call_shifts_col + 1
+    data_start_row = 3
 
-    training_hrs_col  = on_call_flat_rate_col + 1
-    training_pay_col  = training_hrs_col + 1   # Calculated: Training Hrs × Rate 2
+    # Data cells only differ in style by row fill, so each fill's per-column styles are
+    # resolved once and copied onto the cells instead of re-assigning every style object.
+    # This copies openpyxl's private StyleArray (cell._style), which is why requirements.txt
+    # pins openpyxl to the 3.1 series; check it still exists before raising that pin.
+    row_styles_by_fill = {}
+
+    # Column letters used by the row formulas (fixed for the whole sheet)
+    total_hrs_letter      = col_letters[layout['total_hrs']]
+    fixed_hrs_letter      = col_letters[layout['fixed_hrs']]
+    hours_letter          = col_letters[layout['hours']]
+    rate1_letter          = col_letters[layout['rate1']]
+    on_call_hrs_letter    = col_letters[layout['on_call_hrs']]
+    on_call_shifts_letter = col_letters[layout['on_call_shifts']]
+    on_call_flat_letter   = col_letters[layout['on_call_flat_rate']]
+    training_hrs_letter   = col_letters[layout['training_hrs']]
+    overtime_hrs_letter   = col_letters[layout['overtime_hrs']]
+    rate2_letter          = col_letters[layout['rate2']]
+    holiday_hrs_letter    = col_letters[layout['holiday_hrs']]
+    custom_role_letters = [
+        (col_letters[hrs_col], col_letters[rate_col]) for hrs_col, rate_col in layout['custom_role_cols']
+    ]
 
-    overtime_hrs_col  = training_pay_col + 1
-    rate2_col         = overtime_hrs_col + 1
-    holiday_days_col  = rate2_col + 1
-    holiday_hrs_col   = holiday_days_col + 1
-    sickness_days_col = holiday_hrs_col + 1
-    total_pay_col     = sickness_days_col + 1
+    # Row formulas only differ by row number, so build each one once with an {r} placeholder
+    # Hours = MIN(Total - On-Call - Training, Fixed - On-Call - Training)
+    hours_template = (
+        f"=MIN({total_hrs_letter}{{r}}-{on_call_hrs_letter}{{r}}-{training_hrs_letter}{{r}},"
+        f"{fixed_hrs_letter}{{r}}-{on_call_hrs_letter}{{r}}-{training_hrs_letter}{{r}})"
+    )
+    # Training Pay = Training Hrs × Rate 2 (£12.21 minimum wage)
+    training_pay_template = f"={training_hrs_letter}{{r}}*{rate2_letter}{{r}}"
+    # Overtime = MAX(0, Total - Fixed)
+    overtime_template = f"=MAX(0,{total_hrs_letter}{{r}}-{fixed_hrs_letter}{{r}})"
+    # Total = (Hours × Rate1) + Custom Roles + (On-Call Hrs × Rate1) + (On-Call Shifts × Flat)
+    #       + (Training Hrs × Rate2) + (Overtime × Rate2) + (Holiday Hrs × Rate1)
+    total_pay_template = "+".join([
+        f"=({hours_letter}{{r}}*{rate1_letter}{{r}})",
+        *(f"({hrs_letter}{{r}}*{rate_letter}{{r}})" for hrs_letter, rate_letter in custom_role_letters),
+        f"({on_call_hrs_letter}{{r}}*{rate1_letter}{{r}})",
+        f"({on_call_shifts_letter}{{r}}*{on_call_flat_letter}{{r}})",
+        f"({training_hrs_letter}{{r}}*{rate2_letter}{{r}})",
+        f"({overtime_hrs_letter}{{r}}*{rate2_letter}{{r}})",
+        f"({holiday_hrs_letter}{{r}}*{rate1_letter}{{r}})",
+    ])
 
-    STANDARD_RATE = 12.21
-    data_start_row = 3
-    
-    for row_offset, data in enumerate(payroll_data):
+    # Hours, Overtime and TOTAL PAY hold formulas in the data rows, so their totals
+    # are taken from the preview values instead of the row values.
+    hours_col, overtime_hrs_col, total_pay_col = layout['hours'], layout['overtime_hrs'], layout['total_pay']
+    value_sum_columns = [col for col in layout['sum_columns'] if col not in (hours_col, overtime_hrs_col, total_pay_col)]
+    column_totals = [0.0] * (len(headers) + 1)
+
+    # Build, style and stream out each data row in turn
+    rows = zip(
+        payroll_data,
+        preview_df['Hours'].tolist(),
+        preview_df['Overtime Hrs'].tolist(),
+        preview_df['Total Pay (£)'].tolist(),
+    )
+    for row_offset, (data, hours_worked, overtime_hrs, row_total_pay) in enumerate(rows):
         row_idx = data_start_row + row_offset
-        is_salaried = data['pay_type'] == 'annual'
-        is_non_standard_rate = not is_salaried and abs(data['rate_1'] - STANDARD_RATE) > 0.01
-        has_on_call = data['on_call_hours'] > 0
-        has_training = data['training_hours'] > 0
-
-        # Row highlight priority: on-call > training > salaried > non-standard rate
-        if has_on_call:
-            row_fill = on_call_fill
-        elif has_training:
-            row_fill = training_fill
-        elif is_salaried:
-            row_fill = salaried_fill
-        elif is_non_standard_rate:
-            row_fill = non_standard_rate_fill
-        else:
-            row_fill = None
-
-        def styled_cell(row, col, value, fmt=None, bold=False):
-            c = ws.cell(row=row, column=col, value=value)
-            c.border = thin_border
-            if row_fill:
-                c.fill = row_fill
-            if fmt:
-                c.number_format = fmt
-            if bold:
-                c.font = Font(bold=True)
-            return c
-
-        # Basic columns
-        styled_cell(row_idx, 1, data['employee_name'])
-        styled_cell(row_idx, 2, "Salaried" if is_salaried else "Hourly")
-        styled_cell(row_idx, weekly_hrs_col, data['weekly_hours'], number_format)
-        styled_cell(row_idx, total_hrs_col, data['total_hours_display'], number_format)
-        styled_cell(row_idx, fixed_hrs_col, data['fixed_hours'], number_format, bold=True)
-
-        # Hours = MIN(Total - On-Call, Fixed - On-Call)
-        hours_formula = (
-            f"=MIN({get_column_letter(total_hrs_col)}{row_idx}-{get_column_letter(on_call_hrs_col)}{row_idx}"
-            f"-{get_column_letter(training_hrs_col)}{row_idx},"
-            f"{get_column_letter(fixed_hrs_col)}{row_idx}-{get_column_letter(on_call_hrs_col)}{row_idx}"
-            f"-{get_column_letter(training_hrs_col)}{row_idx})"
-        )
-        c = ws.cell(row=row_idx, column=hours_col, value=hours_formula)
-        c.border = thin_border
-        c.number_format = number_format
-        c.font = Font(bold=True)
-        if row_fill:
-            c.fill = row_fill
-
-        styled_cell(row_idx, rate1_col, data['rate_1'], currency_format)
-
-        # Custom role columns
-        col_offset = 0
-        for role_id, role_name in sorted_roles:
-            hrs_col = custom_role_start_col + col_offset
-            rate_col = custom_role_start_col + col_offset + 1
-            role_data = data['custom_role_hours'].get(role_id, {'hours': 0, 'rate': 0})
-            styled_cell(row_idx, hrs_col, role_data['hours'], number_format)
-            styled_cell(row_idx, rate_col, role_data['rate'], currency_format)
-            col_offset += 2
-
-        # On-Call columns
-        styled_cell(row_idx, on_call_hrs_col, data['on_call_hours'], number_format, bold=True)
-        styled_cell(row_idx, on_call_shifts_col, data['on_call_shift_count'], number_format)
-        styled_cell(row_idx, on_call_flat_rate_col, ON_CALL_FLAT_RATE, currency_format)
-
-        # Training columns
-        styled_cell(row_idx, training_hrs_col, data['training_hours'], number_format, bold=True)
-        # Training Pay = Training Hrs × Rate 2 (£12.21 minimum wage)
-        training_pay_formula = (
-            f"={get_column_letter(training_hrs_col)}{row_idx}*{get_column_letter(rate2_col)}{row_idx}"
-        )
-        c = ws.cell(row=row_idx, column=training_pay_col, value=training_pay_formula)
-        c.border = thin_border
-        c.number_format = currency_format
-        c.font = Font(bold=True)
-        if row_fill:
-            c.fill = row_fill
-
-        # Overtime = MAX(0, Total - Fixed)
-        overtime_formula = (
-            f"=MAX(0,{get_column_letter(total_hrs_col)}{row_idx}"
-            f"-{get_column_letter(fixed_hrs_col)}{row_idx})"
-        )
-        c = ws.cell(row=row_idx, column=overtime_hrs_col, value=overtime_formula)
-        c.border = thin_border
-        c.number_format = number_format
-        c.font = Font(bold=True)
-        if row_fill:
-            c.fill = row_fill
-
-        styled_cell(row_idx, rate2_col, overtime_rate, currency_format)
-        styled_cell(row_idx, holiday_days_col, data['holiday_days'], number_format)
-        styled_cell(row_idx, holiday_hrs_col, data['holiday_hours'], number_format)
-        styled_cell(row_idx, sickness_days_col, data['sickness_days'], number_format)
+        row_fill = get_row_fill(data)
 
         # TOTAL PAY
-        if is_salaried:
-            monthly_salary = data['annual_salary'] / 12
-            c = ws.cell(row=row_idx, column=total_pay_col, value=monthly_salary)
+        if data['pay_type'] == 'annual':
+            total_pay = data['annual_salary'] / 12
         else:
-            hours_letter          = get_column_letter(hours_col)
-            rate1_letter          = get_column_letter(rate1_col)
-            on_call_hrs_letter    = get_column_letter(on_call_hrs_col)
-            on_call_shifts_letter = get_column_letter(on_call_shifts_col)
-            on_call_flat_letter   = get_column_letter(on_call_flat_rate_col)
-            training_hrs_letter   = get_column_letter(training_hrs_col)
-            overtime_hrs_letter   = get_column_letter(overtime_hrs_col)
-            rate2_letter          = get_column_letter(rate2_col)
-            holiday_hrs_letter    = get_column_letter(holiday_hrs_col)
-
-            custom_role_pay_parts = []
-            col_offset = 0
-            for role_id, role_name in sorted_roles:
-                h = get_column_letter(custom_role_start_col + col_offset)
-                r = get_column_letter(custom_role_start_col + col_offset + 1)
-                custom_role_pay_parts.append(f"({h}{row_idx}*{r}{row_idx})")
-                col_offset += 2
-
-            custom_role_pay_formula = "+".join(custom_role_pay_parts) if custom_role_pay_parts else ""
-
-            # Total = (Hours × Rate1) + Custom Roles + (On-Call Hrs × Rate1) + (On-Call Shifts × Flat)
-            #       + (Training Hrs × Rate2) + (Overtime × Rate2) + (Holiday Hrs × Rate1)
-            total_pay_formula = f"=({hours_letter}{row_idx}*{rate1_letter}{row_idx})"
-            if custom_role_pay_formula:
-                total_pay_formula += f"+{custom_role_pay_formula}"
-            total_pay_formula += (
-                f"+({on_call_hrs_letter}{row_idx}*{rate1_letter}{row_idx})"
-                f"+({on_call_shifts_letter}{row_idx}*{on_call_flat_letter}{row_idx})"
-                f"+({training_hrs_letter}{row_idx}*{rate2_letter}{row_idx})"
-                f"+({overtime_hrs_letter}{row_idx}*{rate2_letter}{row_idx})"
-                f"+({holiday_hrs_letter}{row_idx}*{rate1_letter}{row_idx})"
-            )
-            c = ws.cell(row=row_idx, column=total_pay_col, value=total_pay_formula)
-
-        c.border = thin_border
-        c.number_format = currency_format
-        c.font = Font(bold=True)
-        if row_fill:
-            c.fill = row_fill
+            total_pay = total_pay_template.format(r=row_idx)
+
+        values = get_export_row_values(
+            data, sorted_custom_roles, overtime_rate,
+            hours=hours_template.format(r=row_idx),
+            training_pay=training_pay_template.format(r=row_idx),
+            overtime_hrs=overtime_template.format(r=row_idx),
+            total_pay=total_pay,
+        )
+
+        row_styles = row_styles_by_fill.get(row_fill)
+        if row_styles is None:
+            row_styles = [
+                mk_cell(
+                    fill=row_fill,
+                    number_format=column_formats[col],
+                    font=BOLD_FONT if col in bold_columns else None
+                )._style
+                for col in range(1, len(headers) + 1)
+            ]
+            row_styles_by_fill[row_fill] = row_styles
+
+        row_cells = []
+        for value, style in zip(values, row_styles):
+            cell = WriteOnlyCell(ws, value=value)
+            cell._style = copy(style)
+            row_cells.append(cell)
+        ws.append(row_cells)
+
+        for col in value_sum_columns:
+            column_totals[col] += values[col - 1]
+        column_totals[hours_col] += hours_worked
+        column_totals[overtime_hrs_col] += overtime_hrs
+        column_totals[total_pay_col] += row_total_pay
 
     # Totals row
-    last_data_row = data_start_row + len(payroll_data) - 1
-    total_row = last_data_row + 1
-
-    cell = ws.cell(row=total_row, column=1, value="TOTALS")
-    cell.font = Font(bold=True)
-    cell.border = thin_border
-
-    sum_columns = [weekly_hrs_col, total_hrs_col, fixed_hrs_col, hours_col]
-    col_offset = 0
-    for role_id, role_name in sorted_roles:
-        sum_columns.append(custom_role_start_col + col_offset)
-        col_offset += 2
-    sum_columns.extend([
-        on_call_hrs_col, on_call_shifts_col,
-        training_hrs_col,
-        overtime_hrs_col,
-        holiday_days_col, holiday_hrs_col, sickness_days_col,
-        total_pay_col
-    ])
+    totals_cells = [None] * len(headers)
 
-    for col in sum_columns:
-        col_letter = get_column_letter(col)
-        cell = ws.cell(row=total_row, column=col, value=f"=SUM({col_letter}{data_start_row}:{col_letter}{last_data_row})")
-        cell.border = thin_border
-        cell.font = Font(bold=True)
-        if col == total_pay_col:
-            cell.number_format = currency_format
-            cell.fill = PatternFill("solid", fgColor="FFFF00")
-        elif col in [rate1_col, rate2_col, on_call_flat_rate_col]:
-            cell.number_format = currency_format
-        else:
-            cell.number_format = number_format
+    totals_cells[0] = mk_cell("TOTALS", font=BOLD_FONT)
 
-    ws.row_dimensions[2].height = 30
+    for col in layout['sum_columns']:
+        totals_cells[col - 1] = mk_cell(
+            round(column_totals[col], 2),
+            font=BOLD_FONT,
+            fill=TOTAL_PAY_FILL if col == total_pay_col else None,
+            number_format=column_formats[col]
+        )
+
+    ws.append(totals_cells)
+
+    excel_buffer = io.BytesIO()
+    wb.save(excel_buffer)
+    excel_buffer.seek(0)
+    return excel_buffer
+
+
+def create_payroll_excel_values(payroll_data, preview_df, start_date, end_date, overtime_rate, sorted_custom_roles):
+    """Create a values-only payroll export with xlsxwriter and return it as an in-memory .xlsx file (BytesIO).
+
+    Same layout as create_payroll_excel, but Hours, Training Pay, Overtime and TOTAL PAY are
+    written as the values already worked out for the preview instead of live formulas.
+    Rows are flushed as they are written (constant_memory), which is quicker for large exports.
+    """
+    headers = get_export_headers(sorted_custom_roles)
+    layout = get_export_layout(sorted_custom_roles)
+    # The shared layout's column indexes are 1-based; xlsxwriter rows and columns are 0-based
+    column_formats = layout['column_formats']
+    bold_columns = layout['bold_columns']
+
+    excel_buffer = io.BytesIO()
+    wb = xlsxwriter.Workbook(excel_buffer, {'constant_memory': True})
+    ws = wb.add_worksheet("Payroll Export")
 
-    return wb
+    # Column widths and row layout (must be set before the rows are written)
+    ws.set_column(0, 0, 25)
+    ws.set_column(1, 1, 10)
+    ws.set_column(2, len(headers) - 1, 14)
+    ws.set_row(1, 30)
+
+    # Row 1: Period header
+    title_format = wb.add_format({'bold': True, 'font_size': 14, 'align': 'center'})
+    ws.merge_range(
+        0, 0, 0, len(headers) - 1,
+        f"Payroll Period: {start_date.strftime('%d/%m/%Y')} - {end_date.strftime('%d/%m/%Y')}",
+        title_format
+    )
+
+    # Row 2: Column headers
+    header_format = wb.add_format({
+        'bold': True, 'font_color': '#FFFFFF', 'bg_color': '#' + HEADER_FILL.fgColor.rgb[-6:],
+        'align': 'center', 'valign': 'vcenter', 'text_wrap': True, 'border': 1
+    })
+    ws.write_row(1, 0, headers, header_format)
+
+    # Data rows, with one set of per-column formats per row fill
+    row_formats_by_fill = {}
+    column_totals = [0.0] * (len(headers) + 1)
+    rows = zip(
+        payroll_data,
+        preview_df['Hours'].tolist(),
+        preview_df['Training Pay (£)'].tolist(),
+        preview_df['Overtime Hrs'].tolist(),
+        preview_df['Total Pay (£)'].tolist(),
+    )
+    for row_idx, (data, hours_worked, training_pay, overtime_hrs, total_pay) in enumerate(rows, 2):
+        row_fill = get_row_fill(data)
+        row_formats = row_formats_by_fill.get(row_fill)
+        if row_formats is None:
+            row_formats = []
+            for col in range(1, len(headers) + 1):
+                properties = {'border': 1}
+                if row_fill is not NO_FILL:
+                    properties.update(pattern=1, bg_color='#' + row_fill.fgColor.rgb[-6:])
+                if column_formats[col]:
+                    properties['num_format'] = column_formats[col]
+                if col in bold_columns:
+                    properties['bold'] = True
+                row_formats.append(wb.add_format(properties))
+            row_formats_by_fill[row_fill] = row_formats
+
+        values = get_export_row_values(
+            data, sorted_custom_roles, overtime_rate,
+            hours=hours_worked, training_pay=training_pay, overtime_hrs=overtime_hrs, total_pay=total_pay,
+        )
+        for col, value in enumerate(values):
+            ws.write(row_idx, col, value, row_formats[col])
+        for col in layout['sum_columns']:
+            column_totals[col] += values[col - 1]
+
+    # Totals row
+    totals_row = len(payroll_data) + 2
+    ws.write(totals_row, 0, "TOTALS", wb.add_format({'bold': True, 'border': 1}))
+    number_total_format = wb.add_format({'bold': True, 'border': 1, 'num_format': NUMBER_FMT})
+    total_pay_format = wb.add_format({
+        'bold': True, 'border': 1, 'num_format': CURRENCY_FMT,
+        'pattern': 1, 'bg_color': '#' + TOTAL_PAY_FILL.fgColor.rgb[-6:]
+    })
+    for col in layout['sum_columns']:
+        column_format = total_pay_format if col == layout['total_pay'] else number_total_format
+        ws.write_number(totals_row, col - 1, round(column_totals[col], 2), column_format)
+
+    wb.close()
+    excel_buffer.seek(0)
+    return excel_buffer
 
 
 # --- Main Report Generation ---
@@ -887,7 +1175,7 @@ if generate_report_button:
     
     with st.spinner("Testing API connection..."):
         try:
-            test_resp = requests.get(USERS_BASE_URL, headers=HEADERS, params={"limit": 1}, timeout=10)
+            test_resp = SESSION.get(USERS_BASE_URL, params={"limit": 1}, timeout=10)
             test_resp.raise_for_status()
             st.success("✅ API Connection Successful")
         except requests.exceptions.RequestException as e:
@@ -899,13 +1187,39 @@ if generate_report_button:
         st.error("Failed to fetch user data.")
         st.stop()
     
-    role_id_to_name = {}
+    # Drop ignored users straight away so nothing below fetches or computes anything for them
+    users_to_process = [u for u in all_users if u.get("id") not in ignored_user_ids]
+    total_users = len(users_to_process)
+    
+    # Without the role map On-Call and Training shifts would be paid as regular hours
+    role_id_to_name = get_all_roles()
+    if role_id_to_name is None:
+        st.error("Failed to fetch role data.")
+        st.stop()
+    on_call_role_ids = {rid for rid, name in role_id_to_name.items() if name == ON_CALL_ROLE_NAME}
     payroll_data = []
     all_custom_roles = {}
     progress_bar = st.progress(0, text="Processing users...")
     
-    users_to_process = [u for u in all_users if u.get("id") not in ignored_user_ids]
-    total_users = len(users_to_process)
+    # A handful of bulk requests for the whole period, partitioned by user in memory
+    with st.spinner("Fetching shifts, leave and attendance..."):
+        shifts_by_user, leave_by_user, attendance_by_user, failed_user_ids = fetch_period_data(
+            [u.get("id") for u in users_to_process], start_ts, end_ts, start_str, end_str,
+            period_closed=end_date < datetime.date.today(), on_call_role_ids=on_call_role_ids
+        )
+    
+    # A failed batch would silently drop every user in it, so never build a payroll with gaps
+    if failed_user_ids:
+        progress_bar.empty()
+        st.error(f"Failed to fetch shifts or leave for users {', '.join(map(str, failed_user_ids))}. Please try again.")
+        st.stop()
+    
+    # Shift hours and leave for every user in one vectorized pass each
+    pay_details_by_user = {u.get("id"): get_user_pay_details(u) for u in users_to_process}
+    shift_summary = calculate_shift_hours_by_user(
+        list(chain.from_iterable(shifts_by_user.values())), pay_details_by_user, role_id_to_name
+    )
+    leave_summary = calculate_leave_hours_by_user(leave_by_user, start_date, end_date)
     
     for idx, user in enumerate(users_to_process):
         user_id = user.get("id")
@@ -915,7 +1229,7 @@ if generate_report_button:
         
         progress_bar.progress((idx + 1) / total_users, text=f"Processing {employee_name}...")
         
-        pay_details = get_user_pay_details(user)
+        pay_details = pay_details_by_user[user_id]
         pay_type = pay_details["pay_type"]
         
         if pay_type == "hourly":
@@ -928,23 +1242,22 @@ if generate_report_button:
         weekly_hours = pay_details["standard_weekly_hours"]
         fixed_hours = calculate_fixed_hours(weekly_hours, period_days)
         
+        # Debug output is buffered and written once per step instead of one st.write per line
+        debug_lines = []
         if DEBUG_MODE:
-            st.write(f"\n---\n### 👤 Processing: **{employee_name}** (ID: {user_id})")
-
-        shifts_json = get_rotacloud_shifts(start_ts, end_ts, user_id)
-
-        if DEBUG_MODE:
-            st.write(f"📅 **Fetched {len(shifts_json) if shifts_json else 0} shifts for {employee_name}**")
+            shifts_json = shifts_by_user.get(user_id, [])
+            debug_lines.append(f"\n---\n### 👤 Processing: **{employee_name}** (ID: {user_id})")
+            debug_lines.append(f"📅 **Fetched {len(shifts_json) if shifts_json else 0} shifts for {employee_name}**")
 
-        total_hours, base_rate_hours, custom_role_hours, on_call_shifts, training_hours = calculate_shift_hours_by_role(
-            shifts_json, pay_details, rate_1, all_custom_roles, role_id_to_name
+        total_hours, base_rate_hours, custom_role_hours, on_call_shifts, training_hours = (
+            shift_summary.get(user_id) or (0.0, 0.0, {}, [], 0.0)
         )
 
         if DEBUG_MODE:
-            st.write(f"📊 **Shift breakdown for {employee_name}:**")
-            st.write(f"   - Total hours (excl. On-Call & Training): {total_hours}")
-            st.write(f"   - Training hours: {training_hours}")
-            st.write(f"   - On-Call shifts found: {len(on_call_shifts)}")
+            debug_lines.append(f"📊 **Shift breakdown for {employee_name}:**")
+            debug_lines.append(f"   - Total hours (excl. On-Call & Training): {total_hours}")
+            debug_lines.append(f"   - Training hours: {training_hours}")
+            debug_lines.append(f"   - On-Call shifts found: {len(on_call_shifts)}")
 
         for role_id, role_data in custom_role_hours.items():
             if role_id not in all_custom_roles:
@@ -953,20 +1266,22 @@ if generate_report_button:
         on_call_hours = 0.0
         on_call_shift_count = 0
         if on_call_shifts:
+            attendance_data = attendance_by_user.get(user_id, [])
             if DEBUG_MODE:
-                st.write(f"🚨 **Fetching attendance data for On-Call shifts...**")
-            attendance_data = get_attendance_data(start_ts, end_ts, user_id)
-            if DEBUG_MODE and attendance_data:
-                st.write(f"📋 **Fetched {len(attendance_data)} attendance records**")
-                st.json({"sample_attendance": attendance_data[0] if attendance_data else "No data"})
+                debug_lines.append(f"🚨 **Matching attendance data to On-Call shifts...**")
+                if attendance_data:
+                    debug_lines.append(f"📋 **Fetched {len(attendance_data)} attendance records**")
+                flush_debug_markdown(debug_lines)
+                if attendance_data:
+                    st.json({"sample_attendance": attendance_data[0]})
             on_call_hours, on_call_shift_count = calculate_on_call_hours(on_call_shifts, attendance_data)
             if DEBUG_MODE:
-                st.write(f"✅ **On-Call Result: {on_call_hours} hours from {on_call_shift_count} shifts**")
+                debug_lines.append(f"✅ **On-Call Result: {on_call_hours} hours from {on_call_shift_count} shifts**")
         elif DEBUG_MODE:
-            st.write(f"ℹ️ No On-Call shifts for {employee_name}")
+            debug_lines.append(f"ℹ️ No On-Call shifts for {employee_name}")
+        flush_debug_markdown(debug_lines)
 
-        leave_json = get_rotacloud_leave(start_str, end_str, user_id)
-        holiday_days, holiday_hours, sickness_days = calculate_leave_hours(leave_json, start_date, end_date)
+        holiday_days, holiday_hours, sickness_days = leave_summary.get(user_id) or (0.0, 0.0, 0.0)
         
         if total_hours > 0 or holiday_hours > 0 or holiday_days > 0 or sickness_days > 0 or on_call_hours > 0 or training_hours > 0:
             payroll_data.append({
@@ -988,7 +1303,7 @@ if generate_report_button:
                 "holiday_hours": holiday_hours,
                 "sickness_days": sickness_days
             })
-    
+        
     progress_bar.empty()
     
     if not payroll_data:
@@ -1001,66 +1316,77 @@ if generate_report_button:
     hourly_staff.sort(key=lambda x: x['employee_name'].lower())
     payroll_data = salaried_staff + hourly_staff
     
+    # Custom roles are complete once every user is processed; sort them once for the preview and export
+    sorted_custom_roles = sorted(all_custom_roles.items(), key=lambda x: x[1])
+    
     st.subheader("📋 Payroll Preview")
     
     if all_custom_roles:
         st.info(f"🏷️ **Custom Role Rates Found:** {', '.join(all_custom_roles.values())}")
     
-    preview_rows = []
-    for data in payroll_data:
-        hours_worked = min(
-            data['total_hours'],
-            data['fixed_hours'] - data['on_call_hours'] - data['training_hours']
-        )
-        overtime_hrs = max(0, data['total_hours_display'] - data['fixed_hours'])
-
-        if data['pay_type'] == 'annual':
-            total_pay = data['annual_salary'] / 12
-        else:
-            custom_role_pay = sum(rd['hours'] * rd['rate'] for rd in data['custom_role_hours'].values())
-            base_pay        = hours_worked * data['rate_1']
-            on_call_hrs_pay = data['on_call_hours'] * data['rate_1']
-            on_call_flat_pay = data['on_call_shift_count'] * ON_CALL_FLAT_RATE
-            training_pay    = data['training_hours'] * overtime_rate  # Rate 2 (£12.21)
-            overtime_pay    = overtime_hrs * overtime_rate
-            holiday_pay     = data['holiday_hours'] * data['rate_1']
-            total_pay = base_pay + custom_role_pay + on_call_hrs_pay + on_call_flat_pay + training_pay + overtime_pay + holiday_pay
-        
-        row = {
-            'Employee': data['employee_name'],
-            'Type': 'Salaried' if data['pay_type'] == 'annual' else 'Hourly',
-            'Weekly Hrs': data['weekly_hours'],
-            'Total Hrs': data['total_hours_display'],
-            'Fixed Hrs': data['fixed_hours'],
-            'Hours': hours_worked,
-            'Rate 1 (£)': data['rate_1'],
-        }
-        
-        for role_id, role_name in sorted(all_custom_roles.items(), key=lambda x: x[1]):
-            role_data = data['custom_role_hours'].get(role_id, {'hours': 0, 'rate': 0})
-            row[f'{role_name} Hrs'] = role_data['hours']
-        
-        row['On-Call Hrs']   = data['on_call_hours']
-        row['On-Call Shifts'] = data['on_call_shift_count']
-        row['Training Hrs']  = data['training_hours']
-        row['Training Pay (£)'] = round(data['training_hours'] * overtime_rate, 2)  # Rate 2 (£12.21)
-        row['Overtime Hrs']  = overtime_hrs
-        row['Holiday (Days)'] = data['holiday_days']
-        row['Holiday (Hrs)'] = data['holiday_hours']
-        row['Sickness (Days)'] = data['sickness_days']
-        row['Total Pay (£)'] = round(total_pay, 2)
-        
-        preview_rows.append(row)
-    
-    preview_df = pd.DataFrame(preview_rows)
+    # Preview columns and pay are worked out column-wise over every employee at once
+    payroll_df = pd.DataFrame(payroll_data)
+    is_salaried = payroll_df['pay_type'] == 'annual'
+    hours_worked = np.minimum(
+        payroll_df['total_hours'],
+        payroll_df['fixed_hours'] - payroll_df['on_call_hours'] - payroll_df['training_hours']
+    )
+    overtime_hrs = (payroll_df['total_hours_display'] - payroll_df['fixed_hours']).clip(lower=0)
+
+    # Custom role pay: every (employee row, hours, rate) entry in one array, summed per row with bincount
+    role_entries = np.array([
+        (pos, rd['hours'], rd['rate'])
+        for pos, roles in enumerate(payroll_df['custom_role_hours'])
+        for rd in roles.values()
+    ], dtype=float).reshape(-1, 3)
+    custom_role_pay  = np.bincount(
+        role_entries[:, 0].astype(int), weights=role_entries[:, 1] * role_entries[:, 2], minlength=len(payroll_df)
+    )
+    base_pay         = hours_worked * payroll_df['rate_1']
+    on_call_hrs_pay  = payroll_df['on_call_hours'] * payroll_df['rate_1']
+    on_call_flat_pay = payroll_df['on_call_shift_count'] * ON_CALL_FLAT_RATE
+    training_pay     = payroll_df['training_hours'] * overtime_rate  # Rate 2 (£12.21)
+    overtime_pay     = overtime_hrs * overtime_rate
+    holiday_pay      = payroll_df['holiday_hours'] * payroll_df['rate_1']
+    hourly_pay = base_pay + custom_role_pay + on_call_hrs_pay + on_call_flat_pay + training_pay + overtime_pay + holiday_pay
+    total_pay = np.where(is_salaried, payroll_df['annual_salary'] / 12, hourly_pay)
+
+    preview_columns = {
+        'Employee': payroll_df['employee_name'],
+        'Type': np.where(is_salaried, 'Salaried', 'Hourly'),
+        'Weekly Hrs': payroll_df['weekly_hours'],
+        'Total Hrs': payroll_df['total_hours_display'],
+        'Fixed Hrs': payroll_df['fixed_hours'],
+        'Hours': hours_worked,
+        'Rate 1 (£)': payroll_df['rate_1'],
+    }
+    # Custom role hours in one pass: a tuple per employee with one entry per role column
+    role_hours_df = pd.DataFrame(
+        [tuple(roles.get(role_id, {'hours': 0})['hours'] for role_id, role_name in sorted_custom_roles)
+         for roles in payroll_df['custom_role_hours']],
+        columns=[f'{role_name} Hrs' for role_id, role_name in sorted_custom_roles]
+    )
+    preview_columns.update(role_hours_df.items())
+    preview_columns['On-Call Hrs']      = payroll_df['on_call_hours']
+    preview_columns['On-Call Shifts']   = payroll_df['on_call_shift_count']
+    preview_columns['Training Hrs']     = payroll_df['training_hours']
+    # Pay is rounded per value with Python's round(); np.round scales by 100 and can land a penny off
+    preview_columns['Training Pay (£)'] = training_pay.map(lambda x: round(x, 2))
+    preview_columns['Overtime Hrs']     = overtime_hrs
+    preview_columns['Holiday (Days)']   = payroll_df['holiday_days']
+    preview_columns['Holiday (Hrs)']    = payroll_df['holiday_hours']
+    preview_columns['Sickness (Days)']  = payroll_df['sickness_days']
+    preview_columns['Total Pay (£)']    = pd.Series(total_pay).map(lambda x: round(x, 2))
+
+    preview_df = pd.DataFrame(preview_columns)
     st.dataframe(preview_df, use_container_width=True)
     
-    total_pay_sum          = sum(r['Total Pay (£)'] for r in preview_rows)
-    total_hours_sum        = sum(r['Total Hrs'] for r in preview_rows)
-    total_on_call_hrs_sum  = sum(r['On-Call Hrs'] for r in preview_rows)
-    total_on_call_shft_sum = sum(r['On-Call Shifts'] for r in preview_rows)
-    total_training_hrs_sum = sum(r['Training Hrs'] for r in preview_rows)
-    total_overtime_sum     = sum(r['Overtime Hrs'] for r in preview_rows)
+    total_pay_sum          = preview_df['Total Pay (£)'].sum()
+    total_hours_sum        = preview_df['Total Hrs'].sum()
+    total_on_call_hrs_sum  = preview_df['On-Call Hrs'].sum()
+    total_on_call_shft_sum = preview_df['On-Call Shifts'].sum()
+    total_training_hrs_sum = preview_df['Training Hrs'].sum()
+    total_overtime_sum     = preview_df['Overtime Hrs'].sum()
     
     col1, col2, col3, col4, col5, col6 = st.columns(6)
     with col1:
@@ -1076,17 +1402,20 @@ if generate_report_button:
     with col6:
         st.metric("Total Payroll", f"£{total_pay_sum:,.2f}")
     
-    wb = create_payroll_excel(payroll_data, start_date, end_date, overtime_rate, all_custom_roles)
-    
-    excel_buffer = io.BytesIO()
-    wb.save(excel_buffer)
-    excel_buffer.seek(0)
+    if values_only_export:
+        excel_buffer = create_payroll_excel_values(
+            payroll_data, preview_df, start_date, end_date, overtime_rate, sorted_custom_roles
+        )
+    else:
+        excel_buffer = create_payroll_excel(
+            payroll_data, preview_df, start_date, end_date, overtime_rate, sorted_custom_roles
+        )
     
     filename = f"payroll_export_{start_date.strftime('%Y%m%d')}_{end_date.strftime('%Y%m%d')}.xlsx"
     
     st.download_button(
         label="📥 Download Payroll Export (Excel)",
-        data=excel_buffer.getvalue(),
+        data=excel_buffer,
         file_name=filename,
         mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
         type="primary"
@@ -1,22 +1,49 @@
 # Lightweight imghdr shim for environments that don't include the stdlib imghdr module.
 # Provides a minimal implementation of imghdr.what(filename, h=None)
-# Uses Pillow if available for better detection, falls back to header-signature checks.
+# Checks header signatures first and only falls back to Pillow (if available) when none match
+# and Pillow can be given more than the short header to work with.
 
 import io
+import re
 
 try:
     from PIL import Image
 except Exception:
     Image = None
 
+# (signature, image type) candidates keyed by the first header byte, so only the
+# signatures that can possibly match are compared. WEBP, netpbm, TIFF and ICO are
+# checked separately because a bare prefix is not enough to recognise them.
+# Add more signatures here if you need them.
+_SIGNATURES = [
+    (b'\xff\xd8', 'jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+    (b'BM', 'bmp'),
+    (b'\x01\xda', 'sgi'),
+    (b'qoif', 'qoi'),
+]
+# P1-P6 magic, whitespace, then the width (or a '#' comment) as Pillow's netpbm reader expects
+_NETPBM_HEADER = re.compile(rb'P[1-6][ \t\n\r]+[0-9#]')
+_TIFF_MAGICS = (b'II*\x00', b'MM\x00*')
+# ICO and CUR; an uncompressed truecolour TGA starts with the same bytes as a CUR
+_ICON_MAGICS = (b'\x00\x00\x01\x00', b'\x00\x00\x02\x00')
+_HEADER_SIZE = 32  # Bytes read from a file for the signature checks
+_SIGNATURES_BY_FIRST_BYTE = {}
+for _sig, _kind in _SIGNATURES:
+    _SIGNATURES_BY_FIRST_BYTE.setdefault(_sig[0], []).append((_sig, _kind))
+del _sig, _kind
+
 def what(filename, h=None):
     """
     Minimal drop-in replacement for imghdr.what().
     - filename: path string or file-like or None
     - h: optional header bytes
-    Returns image type string like 'jpeg', 'png', 'gif', 'bmp', 'webp', or None.
+    Returns image type string like 'jpeg', 'png', 'gif', 'bmp', 'webp', 'tiff', 'ppm', 'sgi', 'qoi', or None.
     """
     try:
+        pos = None
         # Normalize header bytes
         if h is None:
             # If filename is bytes-like, treat it as header bytes
@@ -28,7 +55,7 @@ def what(filename, h=None):
                     pos = filename.tell()
                 except Exception:
                     pos = None
-                h = filename.read(32)
+                h = filename.read(_HEADER_SIZE)
                 try:
                     if pos is not None:
                         filename.seek(pos)
@@ -38,7 +65,7 @@ def what(filename, h=None):
             elif isinstance(filename, str):
                 try:
                     with open(filename, "rb") as f:
-                        h = f.read(32)
+                        h = f.read(_HEADER_SIZE)
                 except Exception:
                     h = None
             else:
@@ -52,32 +79,51 @@ def what(filename, h=None):
         if not h:
             return None
 
-        # Prefer Pillow for robust detection if available
+        # Signature-based detection (covers common formats)
+        for sig, kind in _SIGNATURES_BY_FIRST_BYTE.get(h[0], ()):
+            if h.startswith(sig):
+                return kind
+        if h[:4] == b'RIFF' and h[8:12] == b'WEBP':
+            return 'webp'
+        # Netpbm magic must be followed by whitespace (as in the stdlib imghdr) and a number,
+        # so text starting "P1 ..." is not an image. Pillow reports PBM and PGM as 'ppm' too.
+        if _NETPBM_HEADER.match(h):
+            return 'ppm'
+        # TIFF is only taken from the header when the first IFD directly follows it;
+        # any other offset is left to Pillow, which can check it against the file
+        if len(h) >= 8 and h[:4] in _TIFF_MAGICS and \
+                int.from_bytes(h[4:8], 'little' if h[:2] == b'II' else 'big') == 8:
+            return 'tiff'
+
+        # Fall back to Pillow for anything the signatures don't cover, but only when it can
+        # read more than the short header (the whole file, or a longer header from the caller)
+        source = None
         if Image is not None:
+            if isinstance(filename, str):
+                source = filename
+            elif hasattr(filename, "read") and pos is not None:
+                # Image.open seeks to 0 itself, so give it the data from the caller's position instead
+                try:
+                    filename.seek(pos)
+                    source = io.BytesIO(filename.read())
+                finally:
+                    filename.seek(pos)
+            elif len(h) > _HEADER_SIZE:
+                source = io.BytesIO(h)
+        if source is not None:
             try:
-                img = Image.open(io.BytesIO(h))
-                fmt = img.format
+                with Image.open(source) as img:
+                    fmt = img.format
                 if fmt:
                     return fmt.lower()
             except Exception:
-                # Pillow couldn't determine from the header bytes alone - continue to signature checks
+                # Pillow couldn't determine the type either
                 pass
 
-        b = h
-        # Signature-based detection (covers common formats)
-        if b.startswith(b'\xff\xd8'):
-            return 'jpeg'
-        if b.startswith(b'\x89PNG\r\n\x1a\n'):
-            return 'png'
-        if b[:6] in (b'GIF87a', b'GIF89a'):
-            return 'gif'
-        if b.startswith(b'BM'):
-            return 'bmp'
-        if len(b) >= 12 and b[:4] == b'RIFF' and b[8:12] == b'WEBP':
-            return 'webp'
-        if b.startswith(b'\x00\x00\x01\x00') or b.startswith(b'\x00\x00\x02\x00'):
+        # ICO/CUR prefixes are shared with other formats (e.g. TGA), so they are only checked
+        # after Pillow, and need a non-zero image count and a zero reserved byte in the first entry
+        if h[:4] in _ICON_MAGICS and h[4:6] != b'\x00\x00' and h[9:10] == b'\x00':
             return 'ico'
-        # Add more signatures if you need them
         return None
     except Exception:
         return None